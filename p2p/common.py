@@ -0,0 +1,47 @@
+"""
+common.py — helpers shared by coordinator.py and subcoordinator.py.
+
+ - dumps / loads: orjson when installed, stdlib json otherwise (dumps always returns bytes)
+ - json_response: web.json_response serialized once with the fast encoder
+ - cors_mw: CORS for the origins listed in STRANDCAST_CORS_ORIGINS (comma-separated).
+   With the variable unset no origin is allowed, the same as aiohttp_cors.setup(app)
+   without defaults: no CORS headers are sent and preflights are refused with 403.
+"""
+import json
+import os
+from aiohttp import web
+
+try:
+    import orjson
+    dumps = orjson.dumps      # already returns bytes
+    loads = orjson.loads      # accepts bytes directly
+except ImportError:
+    def dumps(obj):
+        return json.dumps(obj, separators=(",", ":")).encode()
+    loads = json.loads
+
+def json_response(obj, status=200):
+    """web.json_response, but serialized once with the fast encoder."""
+    return web.Response(body=dumps(obj), status=status, content_type="application/json")
+
+CORS_ORIGINS = frozenset(o.strip() for o in os.environ.get("STRANDCAST_CORS_ORIGINS", "").split(",") if o.strip())
+CORS_PREFLIGHT_HEADERS = {
+    "Access-Control-Allow-Methods": "GET, POST, OPTIONS",
+    "Access-Control-Allow-Headers": "Content-Type",
+}
+
+@web.middleware
+async def cors_mw(request, handler):
+    origin = request.headers.get("Origin")
+    if request.method == "OPTIONS" and origin and "Access-Control-Request-Method" in request.headers:
+        # preflight: answered here, so no OPTIONS route is needed
+        if origin not in CORS_ORIGINS:
+            raise web.HTTPForbidden(text="CORS origin not allowed")
+        return web.Response(status=204, headers={"Access-Control-Allow-Origin": origin,
+                                                 "Vary": "Origin", **CORS_PREFLIGHT_HEADERS})
+    resp = await handler(request)
+    # websocket and streamed responses have already sent their headers
+    if origin in CORS_ORIGINS and not resp.prepared:
+        resp.headers["Access-Control-Allow-Origin"] = origin
+        resp.headers.add("Vary", "Origin")
+    return resp
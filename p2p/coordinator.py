@@ -10,56 +10,54 @@ Serves ./www/ static (peer.html / peer.js).
 This version reliably spawns subcoordinator processes and logs their output to files.
 """
 import asyncio
-import json
+import gzip
+import hashlib
+import mimetypes
 import os
 import signal
 import sys
 import subprocess
 import time
+import aiohttp
 from aiohttp import web
-import aiohttp_cors
 import socket
+from common import dumps, loads, json_response, cors_mw
+
+try:
+    import uvloop             # optional; libuv-based event loop (not available on Windows)
+except ImportError:
+    uvloop = None
 
 BASE_DIR = os.path.dirname(__file__)
 WWW_DIR = os.path.join(BASE_DIR, "www")
+WWW_ABS = os.path.abspath(WWW_DIR)
 HOST = "0.0.0.0"
 PORT = 9000
 
-# Subcoordinator spawn base port (will try increasing ports from here)
-SUB_BASE_PORT = 10080
-SUB_PORT_LIMIT = 200  # try ports SUB_BASE_PORT .. SUB_BASE_PORT+SUB_PORT_LIMIT
-
 # Globals
 PEERS = []        # flat list of all peer entries
 PEER_MAP = {}     # name -> entry
 STRAND_TO_INFO = {}  # strand -> {port, proc, url, log}
-
-LOCK = asyncio.Lock()
+STRAND_INDEX = {}    # strand -> [{name, port, ctrl}], kept in step with PEER_MAP by register
+STRAND_VIEWS = {}    # name -> that peer's dict inside STRAND_INDEX
+PEERS_BODY = None    # cached /peers response body; reset whenever PEER_MAP changes
+PEERS_BODY_GZ = None # gzip of PEERS_BODY, or None when the body is too small to bother
+GZIP_MIN = 1024      # /peers bodies shorter than this are always sent uncompressed
+MAX_BODY = 4096      # largest /register or /lookup body accepted; real ones are ~100 bytes
+STATIC_CACHE = {}    # path under www/ -> (body, etag, content_type), loaded at startup
+
+LOCK = asyncio.Lock()     # guards the peer registry (PEERS / PEER_MAP / STRAND_INDEX)
+STRAND_LOCKS = {}         # strand -> asyncio.Lock serializing that strand's subcoordinator spawn
 routes = web.RouteTableDef()
+HTTP = web.AppKey("http", aiohttp.ClientSession)  # shared client for subcoordinator calls
 
-def wait_for_port(host, port, timeout=5.0):
-    start = time.time()
-    while time.time() - start < timeout:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            try:
-                s.connect((host, port))
-                return True
-            except ConnectionRefusedError:
-                time.sleep(0.1)
-    raise TimeoutError(f"Port {port} not ready after {timeout}s")
-
-def find_free_port(start=SUB_BASE_PORT, limit=SUB_PORT_LIMIT):
-    p = start
-    for _ in range(limit):
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            try:
-                s.bind(("0.0.0.0", p))
-                return p
-            except OSError:
-                p += 1
-    raise RuntimeError("no free ports found for subcoordinator")
+def find_free_port():
+    """Ask the kernel for an unused port for a new subcoordinator."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("0.0.0.0", 0))
+        return s.getsockname()[1]
 
-def spawn_subcoordinator(strand, port):
+async def spawn_subcoordinator(strand, port):
     py = sys.executable or "python3"
     script = os.path.abspath(os.path.join(BASE_DIR, "subcoordinator.py"))
 
@@ -68,35 +66,32 @@ def spawn_subcoordinator(strand, port):
 
     print(f"[Coordinator] Spawning subcoord at ABSOLUTE PATH: {script}")
 
-    proc = subprocess.Popen(
+    # fork/exec off the event loop; readiness is polled by wait_subcoordinator_ready
+    proc = await asyncio.to_thread(
+        subprocess.Popen,
         [py, script, "--port", str(port), "--strand", strand],
         cwd=BASE_DIR,
         stdout=None,  # avoids buffer blocking
         stderr=None
     )
-
-    # Wait until subcoordinator is actually listening
-    wait_for_port("127.0.0.1", port)
-    print(f"[Coordinator] Subcoordinator for strand '{strand}' ready on port {port}")
     return proc
 
-async def wait_subcoordinator_ready(port, timeout=6.0):
+async def wait_subcoordinator_ready(session, port, timeout=6.0):
     """
     Poll the subcoordinator /health endpoint until ready or timeout.
     Returns True if ready, False otherwise.
     """
-    import aiohttp
     url = f"http://127.0.0.1:{port}/health"
-    start = time.time()
-    async with aiohttp.ClientSession() as session:
-        while time.time() - start < timeout:
-            try:
-                async with session.get(url, timeout=1) as r:
-                    if r.status == 200:
-                        print(f"[Coordinator] subcoordinator on port {port} ready")
-                        return True
-            except Exception:
-                await asyncio.sleep(0.2)
+    # monotonic deadline: immune to wall-clock jumps while we poll
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            async with session.get(url, timeout=1) as r:
+                if r.status == 200:
+                    print(f"[Coordinator] subcoordinator on port {port} ready")
+                    return True
+        except Exception:
+            await asyncio.sleep(0.2)
     print(f"[Coordinator] subcoordinator on port {port} did NOT become ready in {timeout}s")
     return False
 
@@ -107,10 +102,17 @@ async def register(request):
     Coordinator ensures a subcoordinator exists for the strand, forwards the register request
     to the subcoordinator, and returns the subcoordinator WS URL and prev peer info.
     """
+    # reject oversized or malformed bodies before touching any registry state
+    if (request.content_length or 0) > MAX_BODY:
+        return json_response({"error": "body too large"}, status=413)
     try:
-        data = await request.json()
+        data = loads(await request.read())
+    except web.HTTPRequestEntityTooLarge:
+        return json_response({"error": "body too large"}, status=413)
     except Exception:
-        return web.json_response({"error": "invalid json"}, status=400)
+        return json_response({"error": "invalid json"}, status=400)
+    if not isinstance(data, dict):
+        return json_response({"error": "invalid json"}, status=400)
 
     name = data.get("name")
     port = data.get("port")
@@ -118,67 +120,89 @@ async def register(request):
     strand = data.get("strand") or "default"
 
     if not name:
-        return web.json_response({"error": "missing name"}, status=400)
+        return json_response({"error": "missing name"}, status=400)
+    # both become dict keys, and orjson only serializes str keys (see /peers)
+    if not isinstance(name, str) or not isinstance(strand, str):
+        return json_response({"error": "name and strand must be strings"}, status=400)
 
+    global PEERS_BODY, PEERS_BODY_GZ
     async with LOCK:
         # create or update global entry
         entry = PEER_MAP.get(name)
         if entry:
+            old_strand = entry["strand"]
             entry.update({"port": port, "ctrl": ctrl, "strand": strand})
+            view = STRAND_VIEWS[name]
+            view.update({"port": port, "ctrl": ctrl})
+            if old_strand != strand:
+                members = STRAND_INDEX[old_strand]
+                members.remove(view)
+                if not members:
+                    del STRAND_INDEX[old_strand]
+                STRAND_INDEX.setdefault(strand, []).append(view)
         else:
             entry = {"name": name, "port": port, "ctrl": ctrl, "strand": strand}
             PEERS.append(entry)
             PEER_MAP[name] = entry
-
-        info = STRAND_TO_INFO.get(strand)
-        if not info:
-            # need to spawn a subcoordinator for this strand
-            sub_port = find_free_port()
-            try:
-                proc = spawn_subcoordinator(strand, sub_port)    # <--- FIX: only 1 return value
-                log_path = f"subcoord_{strand}_{sub_port}.log"
-            except Exception as e:
-                return web.json_response({"error": f"failed to spawn subcoordinator: {e}"}, status=500)
-
-            STRAND_TO_INFO[strand] = {
-                "port": sub_port,
-                "proc": proc,
-                "url": f"http://127.0.0.1:{sub_port}",
-                "log": log_path
-            }
-
-            # wait for it to respond
-            ready = await wait_subcoordinator_ready(sub_port, timeout=6.0)
-            if not ready:
-                return web.json_response({
-                    "error": "subcoordinator failed to start",
+            view = {"name": name, "port": port, "ctrl": ctrl}
+            STRAND_VIEWS[name] = view
+            STRAND_INDEX.setdefault(strand, []).append(view)
+        PEERS_BODY = PEERS_BODY_GZ = None
+
+    info = STRAND_TO_INFO.get(strand)
+    if not info:
+        # spawning can take seconds; only registrations for this strand wait on it
+        async with STRAND_LOCKS.setdefault(strand, asyncio.Lock()):
+            info = STRAND_TO_INFO.get(strand)
+            if not info:
+                # need to spawn a subcoordinator for this strand
+                sub_port = find_free_port()
+                try:
+                    proc = await spawn_subcoordinator(strand, sub_port)    # <--- FIX: only 1 return value
+                    log_path = f"subcoord_{strand}_{sub_port}.log"
+                except Exception as e:
+                    return json_response({"error": f"failed to spawn subcoordinator: {e}"}, status=500)
+
+                info = {
+                    "port": sub_port,
+                    "proc": proc,
+                    "url": f"http://127.0.0.1:{sub_port}",
                     "log": log_path
-                }, status=500)
-
-        info = STRAND_TO_INFO[strand]
-        sub_url = info["url"]
+                }
+
+                # wait for it to respond; publish it only afterwards so registrations that
+                # skip the strand lock never forward to a subcoordinator still starting up
+                ready = await wait_subcoordinator_ready(request.app[HTTP], sub_port, timeout=6.0)
+                STRAND_TO_INFO[strand] = info
+                if not ready:
+                    return json_response({
+                        "error": "subcoordinator failed to start",
+                        "log": log_path
+                    }, status=500)
+    sub_url = info["url"]
 
     # Forward register to subcoordinator (outside LOCK)
-    import aiohttp
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(f"{sub_url}/register", json={"name": name, "port": port, "ctrl": ctrl}) as resp:
-                text = await resp.text()
-                ct = resp.headers.get("Content-Type", "")
-                if "application/json" in ct:
-                    try:
-                        j = json.loads(text) if text else {}
-                    except Exception:
-                        j = {}
-                else:
-                    if resp.status >= 400:
-                        return web.json_response({"error": "subcoordinator error text", "detail": text}, status=500)
-                    try:
-                        j = json.loads(text) if text else {}
-                    except Exception:
-                        j = {}
+        session = request.app[HTTP]
+        async with session.post(f"{sub_url}/register",
+                                data=dumps({"name": name, "port": port, "ctrl": ctrl}),
+                                headers={"Content-Type": "application/json"}) as resp:
+            body = await resp.read()
+            ct = resp.headers.get("Content-Type", "")
+            if "application/json" in ct:
+                try:
+                    j = loads(body) if body else {}
+                except Exception:
+                    j = {}
+            else:
+                if resp.status >= 400:
+                    return json_response({"error": "subcoordinator error text", "detail": body.decode(errors="replace")}, status=500)
+                try:
+                    j = loads(body) if body else {}
+                except Exception:
+                    j = {}
     except Exception as e:
-        return web.json_response({"error": f"failed to contact subcoordinator: {e}"}, status=500)
+        return json_response({"error": f"failed to contact subcoordinator: {e}"}, status=500)
 
     # Build WS endpoint returned to browser
     host_header = request.headers.get('X-Forwarded-Host') or request.headers.get('Host') or request.remote
@@ -186,30 +210,50 @@ async def register(request):
 
     sub_ws = f"{'wss' if request.secure else 'ws'}://{host_only}:{info['port']}/ws/{name}"
 
-    return web.json_response({"prev": j or {}, "sub_ws": sub_ws})
+    return json_response({"prev": j or {}, "sub_ws": sub_ws})
 
 @routes.post("/lookup")
 async def lookup(request):
+    if (request.content_length or 0) > MAX_BODY:
+        return json_response({}, status=413)
     try:
-        data = await request.json()
+        data = loads(await request.read())
+    except web.HTTPRequestEntityTooLarge:
+        return json_response({}, status=413)
     except Exception:
-        return web.json_response({}, status=400)
+        return json_response({}, status=400)
+    if not isinstance(data, dict):
+        return json_response({}, status=400)
     name = data.get("name")
-    return web.json_response(PEER_MAP.get(name, {}) or {})
+    return json_response(PEER_MAP.get(name, {}) or {})
 
 @routes.get("/peers")
 async def peers_list(request):
-    # group by strand
-    strands = {}
-    for name, info in PEER_MAP.items():
-        s = info.get("strand", "default")
-        strands.setdefault(s, []).append({"name": name, "port": info.get("port"), "ctrl": info.get("ctrl")})
-    return web.json_response({"peers": list(PEER_MAP.values()), "strands": strands})
+    global PEERS_BODY, PEERS_BODY_GZ
+    if PEERS_BODY is None:
+        PEERS_BODY = dumps({"peers": list(PEER_MAP.values()), "strands": STRAND_INDEX})
+        PEERS_BODY_GZ = gzip.compress(PEERS_BODY, 6) if len(PEERS_BODY) >= GZIP_MIN else None
+    if PEERS_BODY_GZ is not None and "gzip" in request.headers.get("Accept-Encoding", ""):
+        return web.Response(body=PEERS_BODY_GZ, content_type="application/json",
+                            headers={"Content-Encoding": "gzip", "Vary": "Accept-Encoding"})
+    return web.Response(body=PEERS_BODY, content_type="application/json",
+                        headers={"Vary": "Accept-Encoding"})
 
 # Optional simple health endpoint
 @routes.get("/health")
 async def health(request):
-    return web.json_response({"status": "ok", "server": "coordinator"})
+    return json_response({"status": "ok", "server": "coordinator"})
+
+def load_static_cache():
+    """Read every file under www/ into STATIC_CACHE so static hits are served from memory."""
+    for root, _, files in os.walk(WWW_ABS):
+        for fn in files:
+            full = os.path.join(root, fn)
+            with open(full, "rb") as f:
+                body = f.read()
+            rel = os.path.relpath(full, WWW_ABS).replace(os.sep, "/")
+            etag = '"%s"' % hashlib.md5(body).hexdigest()
+            STATIC_CACHE[rel] = (body, etag, mimetypes.guess_type(fn)[0] or "application/octet-stream")
 
 # Serve static files (peer.html / peer.js)
 @routes.get("/{tail:.*}")
@@ -217,19 +261,34 @@ async def static_handler(request):
     path = request.match_info['tail'] or "peer.html"
     if path == "":
         path = "peer.html"
+    cached = STATIC_CACHE.get(path)
+    if cached:
+        body, etag, content_type = cached
+        if request.headers.get("If-None-Match") == etag:
+            return web.Response(status=304, headers={"ETag": etag})
+        return web.Response(body=body, content_type=content_type, headers={"ETag": etag})
+    # not present at startup: fall back to serving from disk
     safe_path = os.path.normpath(os.path.join(WWW_DIR, path))
-    if not safe_path.startswith(os.path.abspath(WWW_DIR)):
+    if not safe_path.startswith(WWW_ABS):
         return web.Response(status=403, text="Forbidden")
     if not os.path.exists(safe_path):
         return web.Response(status=404, text="Not found")
     return web.FileResponse(safe_path)
 
+async def _open_http(app):
+    # one keep-alive pool for every subcoordinator request
+    app[HTTP] = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=100))
+
+async def _close_http(app):
+    await app[HTTP].close()
+
 def init_app():
-    app = web.Application()
+    load_static_cache()
+    # client_max_size makes request.read() stop at MAX_BODY even without a Content-Length
+    app = web.Application(middlewares=[cors_mw], client_max_size=MAX_BODY)
+    app.on_startup.append(_open_http)
+    app.on_cleanup.append(_close_http)
     app.add_routes(routes)
-    cors = aiohttp_cors.setup(app)
-    for r in list(app.router.routes()):
-        cors.add(r)
     return app
 
 async def start():
@@ -239,6 +298,7 @@ async def start():
     site = web.TCPSite(runner, HOST, PORT)
     await site.start()
     print(f"[Coordinator] Running on http://{HOST}:{PORT}  (serving {WWW_DIR})")
+    print(f"[Coordinator] event loop: {'uvloop' if uvloop else 'asyncio'}")
 
     stop = asyncio.Event()
     loop = asyncio.get_running_loop()
@@ -269,6 +329,6 @@ async def start():
 
 if __name__ == "__main__":
     try:
-        asyncio.run(start())
+        (uvloop.run if uvloop else asyncio.run)(start())
     except KeyboardInterrupt:
         print("[Coordinator] Interrupted, exiting.")
@@ -5,16 +5,46 @@
 #   event,origin,seq,sender,peer,timestamp,extra
 # Events: SENT, RECV, FORWARD, CONNECT, CHANNEL_OPEN, CHANNEL_FAIL
 
-import argparse, asyncio, json, signal, sys, time
+import argparse, asyncio, json, signal, sys, threading, time
 from datetime import datetime
 import aiohttp
 from aiohttp import ClientSession, WSMsgType
 from aiortc import RTCPeerConnection, RTCSessionDescription, RTCConfiguration, RTCIceServer
 
+try:
+    import uvloop             # optional; libuv-based event loop (not available on Windows)
+except ImportError:
+    uvloop = None
+
+try:
+    import orjson
+    dumps = orjson.dumps      # already returns bytes
+    loads = orjson.loads      # accepts str or bytes
+except ImportError:
+    def dumps(obj):
+        return json.dumps(obj, separators=(",", ":")).encode()
+    loads = json.loads
+
 COORD_URL = "http://127.0.0.1:9000"
 COORD_WS_BASE = "http://127.0.0.1:9000/ws"
 ICE_SERVERS = [{"urls":"stun:stun.l.google.com:19302"}]
 
+SESSION = None   # one ClientSession for the whole process; see get_session()
+
+async def get_session():
+    """Return the process-wide ClientSession, creating it on first use."""
+    global SESSION
+    if SESSION is None or SESSION.closed:
+        connector = aiohttp.TCPConnector(limit=0, ttl_dns_cache=300, keepalive_timeout=75,
+                                         enable_cleanup_closed=True)
+        SESSION = ClientSession(connector=connector,
+                                json_serialize=lambda obj: dumps(obj).decode())
+    return SESSION
+
+async def close_session():
+    if SESSION is not None and not SESSION.closed:
+        await SESSION.close()
+
 def nowts():
     return datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
 
@@ -23,22 +53,15 @@ def log(name, text):
     with open(fn, "a") as f:
         f.write(f"[{nowts()}] {text}\n")
 
-def metrics_write(name, row):
-    fn = f"peer_{name}_metrics.csv"
-    header = "event,origin,seq,sender,peer,timestamp,extra\n"
-    try:
-        first = False
-        try:
-            with open(fn, 'r'):
-                first = True
-        except FileNotFoundError:
-            first = False
-        with open(fn, 'a') as f:
-            if not first:
-                f.write(header)
-            f.write(','.join(map(str, row)) + '\n')
-    except Exception:
-        pass
+async def send_obj(ws, obj):
+    """ws.send_json with the fast encoder; sent as TEXT, which is what the coordinator reads."""
+    await ws.send_str(dumps(obj).decode())
+
+METRICS_HEADER = "event,origin,seq,sender,peer,timestamp,extra\n"
+METRICS_FLUSH_INTERVAL = 0.05  # seconds between metrics buffer flushes
+WS_QUEUE_MAX = 1024            # signaling messages waiting for _ws_sender
+DATA_QUEUE_MAX = 4096          # datachannel messages waiting for _data_consumer
+SEEN_CAP = 65536               # (origin, seq) keys per generation of the seen sets
 
 class Peer:
     def __init__(self, name, port):
@@ -49,16 +72,91 @@ class Peer:
         self.session = None
         self.ws = None
         self.running = True
+        self._stdin_q = asyncio.Queue()   # lines from the stdin reader thread; None wakes interactive()
 
         self.rtc_config = RTCConfiguration([RTCIceServer(**s) for s in ICE_SERVERS])
         self.pc_map = {}
         self.dc_map = {}
         self._pending_answer = {}
         self._pending_channel_open = {}
+        self._connecting = {}   # target -> Task running connect_to_peer(target); one per target
+        # two generations: when `seen` fills up it becomes `_seen_old` and the previous old
+        # generation is dropped, so memory stays bounded at 2 * SEEN_CAP keys
         self.seen = set()
+        self._seen_old = set()
+
+        # metrics rows are buffered in memory and written out by _flush_metrics_loop
+        self._metrics_fp = open(f"peer_{name}_metrics.csv", "a", buffering=1 << 16)
+        if self._metrics_fp.tell() == 0:
+            self._metrics_fp.write(METRICS_HEADER)
+        self._metrics_buf = []
+        self._metrics_task = None
+
+        # signaling messages are queued by any coroutine and sent in order by _ws_sender
+        self._ws_q = asyncio.Queue(maxsize=WS_QUEUE_MAX)
+        self._ws_task = None
+
+        # datachannel messages from every channel are handled in order by _data_consumer
+        self._data_q = asyncio.Queue(maxsize=DATA_QUEUE_MAX)
+        self._data_task = None
+
+    def mark_seen(self, key):
+        """Record key; returns False if it was already seen."""
+        if key in self.seen or key in self._seen_old:
+            return False
+        self.seen.add(key)
+        if len(self.seen) >= SEEN_CAP:
+            self._seen_old, self.seen = self.seen, set()
+        return True
+
+    def metrics_write(self, row):
+        self._metrics_buf.append(','.join(map(str, row)) + '\n')
+
+    def _flush_metrics(self):
+        if self._metrics_buf:
+            try:
+                self._metrics_fp.write(''.join(self._metrics_buf))
+                self._metrics_fp.flush()
+            except Exception:
+                pass
+            self._metrics_buf.clear()
+
+    async def _flush_metrics_loop(self):
+        while True:
+            await asyncio.sleep(METRICS_FLUSH_INTERVAL)
+            self._flush_metrics()
+
+    def ws_send(self, obj):
+        """Queue a signaling message for the coordinator websocket."""
+        try:
+            self._ws_q.put_nowait(obj)
+        except asyncio.QueueFull:
+            print(f"[{self.name}] WS send queue full, dropping {obj.get('type')}")
+
+    async def _ws_sender(self):
+        while True:
+            obj = await self._ws_q.get()
+            try:
+                await send_obj(self.ws, obj)
+            except Exception as e:
+                print(f"[{self.name}] WS send failed: {e}")
+
+    def _enqueue_data(self, payload):
+        try:
+            self._data_q.put_nowait(payload)
+        except asyncio.QueueFull:
+            print(f"[{self.name}] data queue full, dropping message")
+
+    async def _data_consumer(self):
+        while True:
+            payload = await self._data_q.get()
+            try:
+                await self._on_data(payload)
+            except Exception as e:
+                print(f"[{self.name}] data handler error: {e}")
 
     async def register(self):
-        self.session = ClientSession()
+        self.session = await get_session()
         url = COORD_URL + "/register"
         payload = {"name": self.name, "port": self.port, "ctrl": self.ctrl_port}
         async with self.session.post(url, json=payload) as resp:
@@ -75,16 +173,19 @@ class Peer:
         ws_url = COORD_WS_BASE + f"/{self.name}"
         self.ws = await self.session.ws_connect(ws_url)
         print(f"[{self.name}] WS connected to coordinator")
+        self._ws_task = asyncio.ensure_future(self._ws_sender())
         asyncio.ensure_future(self._ws_loop())
 
     async def _ws_loop(self):
         async for msg in self.ws:
             if msg.type == WSMsgType.TEXT:
                 try:
-                    obj = json.loads(msg.data)
+                    obj = loads(msg.data)
                 except Exception:
                     continue
-                await self._handle_ws_message(obj)
+                # the subcoordinator sends several queued messages as one JSON array
+                for o in (obj if isinstance(obj, list) else (obj,)):
+                    await self._handle_ws_message(o)
             elif msg.type == WSMsgType.ERROR:
                 print(f"[{self.name}] WS error: {self.ws.exception()}")
         print(f"[{self.name}] WS closed")
@@ -128,26 +229,26 @@ class Peer:
                 print(f"[{self.name}] DataChannel open (from {from_name})")
                 ev.set()
                 log(self.name, f"DATACHANNEL_OPEN from {from_name}")
-                metrics_write(self.name, ("CHANNEL_OPEN", "", "", from_name, nowts(), "incoming"))
+                self.metrics_write(("CHANNEL_OPEN", "", "", from_name, nowts(), "incoming"))
 
             @channel.on("message")
             def _on_message(msg):
                 try:
-                    payload = json.loads(msg)
+                    payload = loads(msg)
                 except Exception:
                     return
-                asyncio.ensure_future(self._on_data(payload))
+                self._enqueue_data(payload)
 
         @pc.on("icecandidate")
         async def on_icecandidate(candidate):
             if candidate:
                 cand = {"candidate": candidate.to_sdp(), "sdpMid": candidate.sdpMid, "sdpMLineIndex": candidate.sdpMLineIndex}
-                await self.ws.send_json({"type":"candidate","to":from_name,"from":self.name,"candidate": cand})
+                self.ws_send({"type":"candidate","to":from_name,"from":self.name,"candidate": cand})
 
         await pc.setRemoteDescription(RTCSessionDescription(sdp, "offer"))
         answer = await pc.createAnswer()
         await pc.setLocalDescription(answer)
-        await self.ws.send_json({"type":"answer","to":from_name,"from":self.name,"sdp": pc.localDescription.sdp})
+        self.ws_send({"type":"answer","to":from_name,"from":self.name,"sdp": pc.localDescription.sdp})
         print(f"[{self.name}] Sent ANSWER to {from_name}")
 
     async def _handle_incoming_answer(self, obj):
@@ -174,6 +275,43 @@ class Peer:
         except Exception:
             pass
 
+    def _channel_to(self, target):
+        """Task resolving to a datachannel to target. Callers share one connection attempt
+        per target; a failed attempt or a closed channel is discarded so the next call
+        starts afresh."""
+        task = self._connecting.get(target)
+        if task is not None and task.done() and (task.cancelled() or task.exception() is not None
+                                                 or task.result().readyState in ("closing", "closed")):
+            task = None
+            # the half-built channel would otherwise be returned as-is by connect_to_peer
+            self.dc_map.pop(target, None)
+            pc = self.pc_map.pop(target, None)
+            if pc is not None:
+                asyncio.ensure_future(pc.close())
+        if task is None:
+            task = self._connecting[target] = asyncio.ensure_future(self.connect_to_peer(target))
+        return task
+
+    def _forward(self, nxt, ch, msg):
+        try:
+            ch.send(dumps(msg).decode())
+            log(self.name, f"FORWARDED to {nxt} origin={msg.get('origin')} seq={msg.get('seq')}")
+            self.metrics_write(("FORWARD", msg.get("origin"), msg.get("seq"), msg.get("sender"), nxt, nowts(), ""))
+        except Exception as e:
+            print(f"[{self.name}] forward error to {nxt}: {e}")
+            log(self.name, f"FORWARD_FAIL {nxt} {e}")
+
+    def _forward_when_connected(self, task, nxt, msg):
+        """Done-callback of a _channel_to task: forward msg once the connection is up."""
+        if task.cancelled():
+            return
+        e = task.exception()
+        if e is not None:
+            print(f"[{self.name}] failed connect to next {nxt}: {e}")
+            log(self.name, f"CONNECT_NEXT_FAIL {nxt} {e}")
+            return
+        self._forward(nxt, task.result(), msg)
+
     async def connect_to_peer(self, target):
         if target in self.dc_map:
             return self.dc_map[target]
@@ -185,7 +323,7 @@ class Peer:
         channel = pc.createDataChannel(target)
         self.dc_map[target] = channel
 
-        self._pending_answer[target] = asyncio.get_event_loop().create_future()
+        self._pending_answer[target] = asyncio.get_running_loop().create_future()
         self._pending_channel_open[target] = asyncio.Event()
 
         @channel.on("open")
@@ -195,25 +333,25 @@ class Peer:
             if ev:
                 ev.set()
             log(self.name, f"DATACHANNEL_OPEN to {target}")
-            metrics_write(self.name, ("CHANNEL_OPEN", "", "", target, nowts(), "outgoing"))
+            self.metrics_write(("CHANNEL_OPEN", "", "", target, nowts(), "outgoing"))
 
         @channel.on("message")
         def on_message(msg):
             try:
-                payload = json.loads(msg)
+                payload = loads(msg)
             except Exception:
                 return
-            asyncio.ensure_future(self._on_data(payload))
+            self._enqueue_data(payload)
 
         @pc.on("icecandidate")
         async def on_icecandidate(candidate):
             if candidate:
                 cand = {"candidate": candidate.to_sdp(), "sdpMid": candidate.sdpMid, "sdpMLineIndex": candidate.sdpMLineIndex}
-                await self.ws.send_json({"type":"candidate","to":target,"from":self.name,"candidate": cand})
+                self.ws_send({"type":"candidate","to":target,"from":self.name,"candidate": cand})
 
         offer = await pc.createOffer()
         await pc.setLocalDescription(offer)
-        await self.ws.send_json({"type":"offer","to": target, "from": self.name, "sdp": pc.localDescription.sdp})
+        self.ws_send({"type":"offer","to": target, "from": self.name, "sdp": pc.localDescription.sdp})
         print(f"[{self.name}] Sent OFFER to {target} via coordinator")
 
         try:
@@ -226,7 +364,7 @@ class Peer:
         except asyncio.TimeoutError:
             raise RuntimeError("timeout waiting for datachannel open")
 
-        metrics_write(self.name, ("CONNECT", "", "", target, nowts(), "success"))
+        self.metrics_write(("CONNECT", "", "", target, nowts(), "success"))
         return channel
 
     async def _on_data(self, msg):
@@ -237,87 +375,86 @@ class Peer:
         origin = msg.get("origin")
         seq = msg.get("seq")
         key = (origin, seq)
-        if key in self.seen:
+        if not self.mark_seen(key):
             return
-        self.seen.add(key)
         sender = msg.get("sender")
         text = msg.get("msg")
         print(f"[{self.name}] RECV origin={origin} seq={seq} from {sender}: {text}")
         log(self.name, f"RECV origin={origin} seq={seq} from {sender}: {text}")
-        metrics_write(self.name, ("RECV", origin, seq, sender, self.name, nowts(), text.replace(',', ' ')))
+        self.metrics_write(("RECV", origin, seq, sender, self.name, nowts(), text.replace(',', ' ')))
 
         nxt = self.next.get("name")
         if nxt:
             ch = self.dc_map.get(nxt)
-            if not ch:
-                try:
-                    ch = await self.connect_to_peer(nxt)
-                except Exception as e:
-                    print(f"[{self.name}] failed connect to next {nxt}: {e}")
-                    log(self.name, f"CONNECT_NEXT_FAIL {nxt} {e}")
-                    return
-            try:
-                ch.send(json.dumps(msg))
-                log(self.name, f"FORWARDED to {nxt} origin={origin} seq={seq}")
-                metrics_write(self.name, ("FORWARD", origin, seq, sender, nxt, nowts(), ""))
-            except Exception as e:
-                print(f"[{self.name}] forward error to {nxt}: {e}")
-                log(self.name, f"FORWARD_FAIL {nxt} {e}")
+            if ch is not None and ch.readyState == "open":
+                self._forward(nxt, ch, msg)
+            else:
+                # connecting can take up to 30 s; forward from the task's done-callback so
+                # _data_consumer moves straight on to the next message
+                self._channel_to(nxt).add_done_callback(
+                    lambda t, nxt=nxt, msg=msg: self._forward_when_connected(t, nxt, msg))
 
     async def originate(self, text):
         seq = int(time.time() * 1000)
         m = {"type":"data","origin": self.name, "seq": seq, "sender": self.name, "msg": text}
-        self.seen.add((self.name, seq))
+        self.mark_seen((self.name, seq))
         nxt = self.next.get("name")
         if not nxt:
             print(f"[{self.name}] No next to send to. Queued.")
             log(self.name, f"QUEUED origin={self.name} seq={seq} msg={text}")
             return
         ch = self.dc_map.get(nxt)
-        if not ch:
+        if ch is None or ch.readyState != "open":
             try:
-                ch = await self.connect_to_peer(nxt)
+                ch = await self._channel_to(nxt)
             except Exception as e:
                 print(f"[{self.name}] connect to next {nxt} failed: {e}")
                 log(self.name, f"CONNECT_NEXT_FAIL {nxt} {e}")
                 return
         try:
-            ch.send(json.dumps(m))
+            ch.send(dumps(m).decode())
             print(f"[{self.name}] Sent origin seq={seq} to {nxt}")
             log(self.name, f"SENT origin={self.name} seq={seq} to {nxt}")
-            metrics_write(self.name, ("SENT", self.name, seq, self.name, nxt, nowts(), text.replace(',', ' ')))
+            self.metrics_write(("SENT", self.name, seq, self.name, nxt, nowts(), text.replace(',', ' ')))
         except Exception as e:
             print(f"[{self.name}] send failed: {e}")
             log(self.name, f"SEND_FAIL {e}")
 
     async def sendto(self, target, text):
         ch = self.dc_map.get(target)
-        if not ch:
+        if ch is None or ch.readyState != "open":
             try:
-                ch = await self.connect_to_peer(target)
+                ch = await self._channel_to(target)
             except Exception as e:
                 print(f"[{self.name}] direct connect to {target} failed: {e}")
                 return
         seq = int(time.time() * 1000)
         msg = {"type":"data","origin": self.name, "seq": seq, "sender": self.name, "msg": text}
         try:
-            ch.send(json.dumps(msg))
+            ch.send(dumps(msg).decode())
             print(f"[{self.name}] Sent direct to {target} seq={seq}")
             log(self.name, f"SENT_DIRECT to {target} seq={seq} msg={text}")
-            metrics_write(self.name, ("SENT_DIRECT", self.name, seq, self.name, target, nowts(), text.replace(',', ' ')))
+            self.metrics_write(("SENT_DIRECT", self.name, seq, self.name, target, nowts(), text.replace(',', ' ')))
         except Exception as e:
             print(f"[{self.name}] direct send error: {e}")
 
     async def interactive(self):
         print(f"[{self.name}] Interactive ready. 'sendto <peer> <msg>' or plain text to originate. 'list' to list peers. 'quit' to exit.")
-        loop = asyncio.get_event_loop()
-        while self.running:
+        loop = asyncio.get_running_loop()
+        q = self._stdin_q
+
+        # one reader thread for the life of the process instead of an executor job per line
+        def _read_stdin():
             try:
-                line = await loop.run_in_executor(None, sys.stdin.readline)
+                for l in sys.stdin:
+                    loop.call_soon_threadsafe(q.put_nowait, l)
             except Exception:
-                break
-            if not line:
-                await asyncio.sleep(0.1)
+                pass
+        threading.Thread(target=_read_stdin, daemon=True).start()
+
+        while self.running:
+            line = await q.get()
+            if line is None:
                 continue
             line = line.strip()
             if not line:
@@ -338,6 +475,11 @@ class Peer:
                 continue
             await self.originate(line)
 
+    def stop(self):
+        """Ask interactive() to return; call from the event loop thread."""
+        self.running = False
+        self._stdin_q.put_nowait(None)
+
     async def close(self):
         self.running = False
         for ch in list(self.dc_map.values()):
@@ -350,17 +492,29 @@ class Peer:
                 await pc.close()
             except:
                 pass
+        if self._ws_task:
+            self._ws_task.cancel()
+        if self._data_task:
+            self._data_task.cancel()
         if self.ws:
             await self.ws.close()
-        if self.session:
-            await self.session.close()
+        if self._metrics_task:
+            self._metrics_task.cancel()
+        self._flush_metrics()
+        self._metrics_fp.close()
 
     async def run(self):
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGINT, self.stop)
+        loop.add_signal_handler(signal.SIGTERM, self.stop)
+        self._metrics_task = asyncio.ensure_future(self._flush_metrics_loop())
+        self._data_task = asyncio.ensure_future(self._data_consumer())
         await self.register()
         try:
             await self.interactive()
         finally:
             await self.close()
+            await close_session()
             print(f"[{self.name}] exited.")
 
 
@@ -371,20 +525,11 @@ def main():
     args = parser.parse_args()
 
     peer = Peer(args.name, args.port)
-    loop = asyncio.get_event_loop()
-
-    def _on_sig():
-        peer.running = False
-    loop.add_signal_handler(signal.SIGINT, _on_sig)
-    loop.add_signal_handler(signal.SIGTERM, _on_sig)
-
+    print(f"[{args.name}] event loop: {'uvloop' if uvloop else 'asyncio'}")
     try:
-        loop.run_until_complete(peer.run())
+        (uvloop.run if uvloop else asyncio.run)(peer.run())
     except KeyboardInterrupt:
         pass
-    finally:
-        loop.run_until_complete(asyncio.sleep(0.1))
-        loop.close()
 
 if __name__ == "__main__":
     main()
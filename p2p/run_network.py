@@ -2,8 +2,10 @@
 # run_network.py
 # Launcher: starts coordinator_static.py and several peers. When possible opens new consoles and opens browser pages for HTML clients.
 
-import subprocess, sys, time, platform, os, webbrowser
+import subprocess, sys, time, platform, os, webbrowser, json, urllib.request
+from concurrent.futures import ThreadPoolExecutor
 PY = sys.executable
+COORD_URL = "http://127.0.0.1:9000"
 
 # adjust peer list as desired
 peers = [("A",10001), ("B",10002), ("C",10003)]
@@ -28,31 +30,69 @@ def start_console(cmd):
             except Exception:
                 return subprocess.Popen(cmd)
 
+def fetch_peers():
+    with urllib.request.urlopen(COORD_URL + "/peers", timeout=0.5) as resp:
+        return json.loads(resp.read())
+
+def wait_until(check, timeout=10.0):
+    """Poll check() with exponential backoff until it returns true; False on timeout."""
+    delay = 0.02
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            if check():
+                return True
+        except Exception:
+            pass
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(delay)
+        delay = min(delay * 2, 0.5)
+
+def is_registered(name):
+    return any(p.get("name") == name for p in fetch_peers().get("peers", []))
+
+def abort_launch(procs, why):
+    """Stop what has been started so far and exit; a half-built chain is worse than none."""
+    print(why + " Stopping the launch.")
+    for p in procs:
+        try:
+            p.terminate()
+        except Exception:
+            pass
+    sys.exit(1)
+
 if __name__ == '__main__':
     procs = []
     # start coordinator (static + signaling)
     print("Starting coordinator (static + signaling)...")
     procs.append(start_console([PY, "coordinator_static.py"]))
-    time.sleep(1.0)
+    # readiness probes instead of fixed sleeps
+    if not wait_until(fetch_peers):
+        abort_launch(procs, "Coordinator did not answer on /peers.")
 
     # start peers in consoles
     for name, port in peers:
         print(f"Starting peer {name} (python) ...")
-        procs.append(start_console([PY, "peer_webrtc.py", name, str(port)]))
-        time.sleep(0.6)
+        procs.append(start_console([PY, "peer_webwrtc.py", name, str(port)]))
+        # peers join the chain in registration order, so wait for this one before the next
+        if not wait_until(lambda: is_registered(name), timeout=5.0):
+            abort_launch(procs, f"Peer {name} did not register.")
 
     # open browser pages for peers (so people can join via link)
     # We'll open a browser tab for each peer name at http://localhost:9000/peer.html?name=<Name>
-    time.sleep(1.0)
     base = "http://127.0.0.1:9000/peer.html"
-    for name, port in peers:
+    def open_tab(name, port):
         url = f"{base}?name={name}&port={port}"
         try:
             webbrowser.open_new_tab(url)
             print(f"Opened browser tab for {name}: {url}")
-            time.sleep(0.4)
         except Exception as e:
             print("Could not open browser tab:", e)
+    # each open may block on spawning the browser, so open all tabs at once
+    with ThreadPoolExecutor(max_workers=len(peers)) as ex:
+        for name, port in peers:
+            ex.submit(open_tab, name, port)
 
     print("Launcher done. Coordinator is serving static files from ./www (peer.html).")
     print("You can also share this link: http://<host>:9000/peer.html?name=<yourname> for browser-based join.")
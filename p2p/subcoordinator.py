@@ -14,13 +14,21 @@ This variant logs handshake attempts and errors so connection problems are visib
 """
 import argparse
 import asyncio
-import json
+import itertools
+import logging
+import logging.handlers
 import os
-import traceback
+import queue
 from aiohttp import web, WSMsgType
-import aiohttp_cors
 import signal
 import sys
+import time
+from common import dumps, loads, json_response, cors_mw
+
+try:
+    import uvloop             # optional; libuv-based event loop (not available on Windows)
+except ImportError:
+    uvloop = None
 
 routes = web.RouteTableDef()
 
@@ -32,9 +40,33 @@ args = parser.parse_args()
 PORT = args.port
 STRAND = args.strand
 
-PEERS = []   # ordered list of entries {name, port, ctrl, _ws?}
-PEER_MAP = {}
-LOCK = asyncio.Lock()
+PEER_MAP = {}   # name -> entry {name, port, ctrl, _ws?}; insertion order is chain order
+# There is no lock around PEER_MAP: every handler runs on the one event loop thread
+# and no mutation spans an await, so each read-modify-write is already atomic. Code that
+# awaits (sends) works on a snapshot taken before its first await.
+PEERS_BODY = None   # cached /peers response body; reset whenever PEER_MAP changes
+MAX_BODY = 4096     # largest /register body accepted
+
+# Entries whose websocket has been gone for longer than SWEEP_TTL are dropped by sweeper(),
+# so a long-running strand does not keep every peer that ever joined.
+SWEEP_INTERVAL = 30.0   # seconds between sweeps
+SWEEP_TTL = 300.0       # seconds an entry may stay without a websocket
+LAST_SEEN = {}          # name -> monotonic time of register / websocket disconnect
+# numbers for unnamed registrations; never reused, since the sweeper shrinks PEER_MAP
+_auto_names = itertools.count(1)
+
+# New-peer announcements are coalesced and sent as one NEW_PEERS message per flush,
+# so a burst of K registrations costs one send per connected peer instead of K.
+NEW_PEERS_FLUSH = 0.05   # seconds
+PENDING_NEW = []         # [{name, port, ctrl}] registered since the last flush
+_new_peers_task = None
+
+# Text (signaling) messages to a websocket go through its OUTBOX queue. writer_loop sends
+# as soon as a message is queued; anything that queued up meanwhile (e.g. while the previous
+# send was in flight) goes out in the same frame as a JSON array, so nothing is held back.
+SIGNAL_BATCH = 64     # most messages per frame
+OUTBOX_MAX = 256
+OUTBOX = {}           # WebSocketResponse -> asyncio.Queue of JSON text
 
 # Store latest frame for automatic delivery
 LATEST_FRAMES = {}  # STRAND -> bytes
@@ -42,109 +74,196 @@ LATEST_FRAMES = {}  # STRAND -> bytes
 def make_entry(name, port, ctrl):
     return {"name": name, "port": port, "ctrl": ctrl, "_ws": None}
 
+def detach_ws(entry, ws):
+    """Clear entry's websocket if it is still ws; its SWEEP_TTL starts counting now."""
+    if entry.get("_ws") is ws:
+        entry["_ws"] = None
+        LAST_SEEN[entry["name"]] = time.monotonic()
+
 # --- Helpers for logging ---
+# Records are queued by the event loop and written to stdout by a QueueListener thread,
+# so logging never blocks a handler on a console write.
+logger = logging.getLogger("subcoord")
+logger.setLevel(logging.INFO)
+logger.propagate = False
+_log_queue = queue.SimpleQueue()
+logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+_log_stream = logging.StreamHandler(sys.stdout)
+_log_stream.setFormatter(logging.Formatter(f"[SubCoord:{STRAND}] %(message)s"))
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_stream)
+
 def log(*parts):
-    print(f"[SubCoord:{STRAND}]", *parts)
-    sys.stdout.flush()
+    logger.info(" ".join(map(str, parts)))
 
 def log_exc(prefix=""):
-    print(f"[SubCoord:{STRAND}]", prefix)
-    traceback.print_exc()
-    sys.stdout.flush()
+    # call from an except block; the traceback is formatted into the queued record
+    logger.exception(prefix)
+
+def enqueue(ws, text):
+    """Queue one JSON text message for ws; returns False if it could not be queued."""
+    q = OUTBOX.get(ws)
+    if q is None:
+        return False
+    try:
+        q.put_nowait(text)
+    except asyncio.QueueFull:
+        log("outbox full, dropping message")
+        return False
+    return True
+
+def queue_obj(ws, obj):
+    return enqueue(ws, dumps(obj).decode())
+
+async def writer_loop(entry, ws, q):
+    """Sole sender of text frames on ws; see OUTBOX."""
+    while True:
+        msgs = [await q.get()]
+        while len(msgs) < SIGNAL_BATCH and not q.empty():
+            msgs.append(q.get_nowait())
+        try:
+            await ws.send_str(msgs[0] if len(msgs) == 1 else "[" + ",".join(msgs) + "]")
+        except Exception as e:
+            log(f"Failed to send {len(msgs)} message(s) to {entry['name']}: {e}")
+            # nothing drains q any more, so stop enqueue() from accepting messages for ws
+            OUTBOX.pop(ws, None)
+            detach_ws(entry, ws)
+            return
+
+async def fan_out(targets, payload, what):
+    """Send payload to every (entry, ws) in targets: text is queued on each OUTBOX, bytes
+    are sent as binary frames concurrently, dropping sockets whose send fails."""
+    if isinstance(payload, str):
+        for _, ws in targets:
+            enqueue(ws, payload)
+        return
+    sends = [ws.send_bytes(payload) for _, ws in targets]
+    results = await asyncio.gather(*sends, return_exceptions=True)
+    for (p, ws), res in zip(targets, results):
+        if isinstance(res, Exception):
+            log(f"Failed to send {what} to {p['name']}: {res}")
+            # drop the dead socket so later fan-outs skip it
+            detach_ws(p, ws)
 
 async def broadcast_frame(frame_bytes):
     """Send frame to all connected peers in this strand."""
-    async with LOCK:
-        for entry in PEER_MAP.values():
-            ws = entry.get("_ws")
-            if ws is not None:
-                try:
-                    await ws.send_bytes(frame_bytes)
-                except Exception as e:
-                    log(f"Failed to send frame to {entry['name']}: {e}")
+    # snapshot recipients before the first await
+    targets = [(entry, entry["_ws"]) for entry in PEER_MAP.values()
+               if entry.get("_ws") is not None]
+    await fan_out(targets, frame_bytes, "frame")
+
+async def sweeper():
+    global PEERS_BODY
+    while True:
+        await asyncio.sleep(SWEEP_INTERVAL)
+        cutoff = time.monotonic() - SWEEP_TTL
+        dead = {p["name"] for p in PEER_MAP.values()
+                if p.get("_ws") is None and LAST_SEEN.get(p["name"], 0) < cutoff}
+        if not dead:
+            continue
+        for name in dead:
+            PEER_MAP.pop(name, None)
+            LAST_SEEN.pop(name, None)
+        PEERS_BODY = None
+        log(f"swept {len(dead)} disconnected peer(s)")
+
+async def flush_new_peers():
+    """Wait one flush interval, then announce every peer registered meanwhile in one message."""
+    await asyncio.sleep(NEW_PEERS_FLUSH)
+    batch = PENDING_NEW[:]
+    PENDING_NEW.clear()
+    targets = [(p, p["_ws"]) for p in PEER_MAP.values()
+               if p.get("_ws") is not None and not p["_ws"].closed]
+    if not batch:
+        return
+    # recipients skip their own entry in the batch
+    text = dumps({"type": "NEW_PEERS", "strand": STRAND, "peers": batch}).decode()
+    await fan_out(targets, text, f"{len(batch)} new peer(s)")
 
 async def broadcast_message(strand, msg, sender=None):
     """Send JSON message to all peers in the strand except sender."""
-    async with LOCK:
-        for entry in PEER_MAP.values():
-            ws = entry.get("_ws")
-            if ws is not None and ws != sender:
-                try:
-                    await ws.send_json(msg)
-                except Exception as e:
-                    log(f"Failed to send message to {entry['name']}: {e}")
+    text = dumps(msg).decode()   # serialized once for every recipient
+    # snapshot recipients before the first await
+    targets = [(entry, entry["_ws"]) for entry in PEER_MAP.values()
+               if entry.get("_ws") is not None and entry["_ws"] is not sender]
+    await fan_out(targets, text, "message")
 
 # --- HTTP routes ---
 
 @routes.post("/register")
 async def register(request):
+    if (request.content_length or 0) > MAX_BODY:
+        return json_response({"error": "body too large"}, status=413)
     try:
-        data = await request.json()
+        data = loads(await request.read())
+    except web.HTTPRequestEntityTooLarge:
+        return json_response({"error": "body too large"}, status=413)
     except Exception as e:
         log("register: invalid json body:", e)
-        return web.json_response({"error": "invalid json"}, status=400)
+        return json_response({"error": "invalid json"}, status=400)
+    if not isinstance(data, dict):
+        return json_response({"error": "invalid json"}, status=400)
 
     name = data.get("name")
     port = data.get("port")
     ctrl = data.get("ctrl")
 
+    global PEERS_BODY, _new_peers_task
     try:
-        async with LOCK:
-            if not name:
-                name = f"peer{len(PEERS)+1}"
-            entry = PEER_MAP.get(name)
-            if entry:
-                entry.update({"port": port, "ctrl": ctrl})
-            else:
-                entry = make_entry(name, port, ctrl)
-                PEERS.append(entry)
-                PEER_MAP[name] = entry
-
-            # --- Notify all existing peers of the new peer for auto-connect ---
-            for p in PEER_MAP.values():
-                ws = p.get("_ws")
-                if ws and p["name"] != name:
-                    try:
-                        await ws.send_json({
-                            "type": "NEW_PEER",
-                            "name": name,
-                            "port": port,
-                            "ctrl": ctrl,
-                            "strand": STRAND
-                        })
-                    except Exception as e:
-                        log(f"Failed to notify {p['name']} of new peer {name}: {e}")
-
-            # prev peer (if any)
-            prev = PEERS[-2] if len(PEERS) > 1 else {}
-            if prev and prev.get("_ws"):
-                try:
-                    await prev["_ws"].send_json({
-                        "type": "UPDATE_NEXT",
-                        "next_name": name,
-                        "next_port": port,
-                        "strand": STRAND
-                    })
-                except Exception as e:
-                    log("failed notify prev:", e)
+        if not name:
+            name = f"peer{next(_auto_names)}"
+            while name in PEER_MAP:   # a peer may have registered under that name explicitly
+                name = f"peer{next(_auto_names)}"
+        entry = PEER_MAP.get(name)
+        if entry:
+            entry.update({"port": port, "ctrl": ctrl})
+        else:
+            entry = make_entry(name, port, ctrl)
+            PEER_MAP[name] = entry
+        PEERS_BODY = None
+        LAST_SEEN[name] = time.monotonic()
+
+        # prev peer (if any)
+        # second-to-last entry; walking a dict in reverse is O(1) per step
+        newest = reversed(PEER_MAP.values())
+        next(newest, None)
+        prev = next(newest, None) or {}
+        prev_ws = prev.get("_ws") if prev else None
+
+        # --- Queue the new peer for the next NEW_PEERS auto-connect announcement ---
+        PENDING_NEW.append({"name": name, "port": port, "ctrl": ctrl})
+        if _new_peers_task is None or _new_peers_task.done():
+            _new_peers_task = asyncio.ensure_future(flush_new_peers())
+
+        # UPDATE_NEXT is queued on prev's outbox right away instead of waiting for the
+        # NEW_PEERS flush above; writer_loop sends it as soon as it is queued
+        if prev_ws is not None:
+            queue_obj(prev_ws, {
+                "type": "UPDATE_NEXT",
+                "next_name": name,
+                "next_port": port,
+                "strand": STRAND
+            })
 
         # success — return prev info
-        return web.json_response(prev or {})
+        return json_response(prev or {})
     except Exception:
         log_exc("Unexpected error in /register")
-        return web.json_response({"error": "internal error"}, status=500)
+        return json_response({"error": "internal error"}, status=500)
 
 @routes.get("/peers")
 async def peers_list(request):
+    global PEERS_BODY
     try:
-        return web.json_response({"peers": [{"name": p["name"], "port": p.get("port"), "ctrl": p.get("ctrl")} for p in PEERS]})
+        if PEERS_BODY is None:
+            PEERS_BODY = dumps({"peers": [{"name": p["name"], "port": p.get("port"), "ctrl": p.get("ctrl")} for p in PEER_MAP.values()]})
+        return web.Response(body=PEERS_BODY, content_type="application/json")
     except Exception:
         log_exc("peers_list error")
-        return web.json_response({"peers": []})
+        return json_response({"peers": []})
 
 @routes.get("/health")
 async def health(request):
-    return web.json_response({"status": "ok", "strand": STRAND})
+    return json_response({"status": "ok", "strand": STRAND})
 
 # --- WebSocket handler ---
 
@@ -165,13 +284,15 @@ async def ws_handler(request):
         return ws
 
     # Associate ws with entry
-    async with LOCK:
-        entry = PEER_MAP.get(name)
-        if not entry:
-            entry = make_entry(name, None, None)
-            PEERS.append(entry)
-            PEER_MAP[name] = entry
-        entry["_ws"] = ws
+    global PEERS_BODY
+    entry = PEER_MAP.get(name)
+    if not entry:
+        entry = make_entry(name, None, None)
+        PEER_MAP[name] = entry
+        PEERS_BODY = None
+    entry["_ws"] = ws
+    q = OUTBOX[ws] = asyncio.Queue(maxsize=OUTBOX_MAX)
+    writer = asyncio.ensure_future(writer_loop(entry, ws, q))
 
     log(f"WS CONNECT {name} (remote={peer_addr})")
 
@@ -187,23 +308,23 @@ async def ws_handler(request):
         async for msg in ws:
             if msg.type == WSMsgType.TEXT:
                 try:
-                    obj = json.loads(msg.data)
+                    obj = loads(msg.data)
                 except Exception:
-                    await ws.send_json({"status":"bad-json"})
+                    queue_obj(ws, {"status":"bad-json"})
                     continue
 
                 to = obj.get("to")
                 if to:
                     target = PEER_MAP.get(to)
                     if target and target.get("_ws"):
-                        try:
-                            await target["_ws"].send_json(obj)
-                            await ws.send_json({"status":"routed","to":to})
-                        except Exception as e:
-                            log("Forward failed:", e)
-                            await ws.send_json({"status":"failed","error": str(e)})
+                        # relay the original text; no need to re-serialize it
+                        if enqueue(target["_ws"], msg.data):
+                            queue_obj(ws, {"status":"routed","to":to})
+                        else:
+                            log("Forward failed: target outbox unavailable")
+                            queue_obj(ws, {"status":"failed","error": "target outbox unavailable"})
                     else:
-                        await ws.send_json({"status":"unroutable","to":to})
+                        queue_obj(ws, {"status":"unroutable","to":to})
                 else:
                     # Broadcast message to all in the strand
                     await broadcast_message(STRAND, obj, sender=ws)
@@ -223,24 +344,20 @@ async def ws_handler(request):
         except Exception:
             pass
     finally:
-        async with LOCK:
-            ent = PEER_MAP.get(name)
-            if ent and ent.get("_ws") is ws:
-                ent["_ws"] = None
+        writer.cancel()
+        OUTBOX.pop(ws, None)
+        ent = PEER_MAP.get(name)
+        if ent:
+            detach_ws(ent, ws)
         log(f"WS DISCONNECT {name}")
     return ws
 
 # --- App setup ---
 
 def init_app():
-    app = web.Application()
+    # client_max_size makes request.read() stop at MAX_BODY even without a Content-Length
+    app = web.Application(middlewares=[cors_mw], client_max_size=MAX_BODY)
     app.add_routes(routes)
-    cors = aiohttp_cors.setup(app)
-    for r in list(app.router.routes()):
-        try:
-            cors.add(r)
-        except Exception:
-            pass
     return app
 
 async def start():
@@ -250,6 +367,7 @@ async def start():
     site = web.TCPSite(runner, "0.0.0.0", PORT)
     await site.start()
     log(f"running on port {PORT}")
+    log(f"event loop: {'uvloop' if uvloop else 'asyncio'}")
     log("registered routes:")
     for r in list(app.router.routes()):
         log(" -", r)
@@ -264,12 +382,17 @@ async def start():
         import signal as _sig
         _sig.signal(_sig.SIGINT, lambda *_: _on_signal())
         _sig.signal(_sig.SIGTERM, lambda *_: _on_signal())
+    sweep_task = asyncio.ensure_future(sweeper())
     await stop.wait()
     log("shutdown")
+    sweep_task.cancel()
     await runner.cleanup()
 
 if __name__ == "__main__":
+    _log_listener.start()
     try:
-        asyncio.run(start())
+        (uvloop.run if uvloop else asyncio.run)(start())
     except KeyboardInterrupt:
         print("Interrupted")
+    finally:
+        _log_listener.stop()   # drains anything still queued
@@ -64,8 +64,13 @@
       ws.onerror = (e) => append("[WS] error: " + (e && e.message));
 
       ws.onmessage = async (evt) => {
-        let obj;
-        try { obj = JSON.parse(evt.data); } catch { return; }
+        let data;
+        try { data = JSON.parse(evt.data); } catch { return; }
+        // the subcoordinator sends several queued messages as one JSON array
+        for (const obj of Array.isArray(data) ? data : [data]) await handleSignal(obj);
+      };
+
+      async function handleSignal(obj) {
         if (obj.type === "UPDATE_NEXT") {
           append("[WS] UPDATE_NEXT -> " + obj.next_name);
           window.nextPeer = obj.next_name;
@@ -75,6 +80,13 @@
           append("[WS] NEW_PEER -> " + obj.name);
           return;
         }
+        if (obj.type === "NEW_PEERS") {
+          // batched announcement; the batch may include this peer's own registration
+          for (const p of obj.peers) {
+            if (p.name !== myName) append("[WS] NEW_PEER -> " + p.name);
+          }
+          return;
+        }
         if (obj.type === "offer" && obj.to === myName) {
           append("[WS] Received OFFER from " + obj.from);
           await handleOffer(obj.from, obj.sdp);
@@ -89,7 +101,7 @@
           await handleCandidate(obj.from, obj.candidate);
           return;
         }
-      };
+      }
 
       // start camera
       await initLocalMedia();
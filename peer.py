@@ -2,121 +2,334 @@
 # Peer process:
 # - registers with coordinator (TCP)
 # - listens for data on a UDP port
-# - runs a TCP control server (ctrl_port = udp_port + 10000) to receive UPDATE_NEXT
+# - receives UPDATE_NEXT datagrams from the coordinator on ctrl_port = udp_port + 10000
+# - one selector thread (io_loop) serves the data and control sockets; it sleeps until one
+#   is readable instead of polling with timeouts
 # - allows interactive sending from any peer
 # - supports "sendto <peername> <message>" to send directly to a specific peer by querying coordinator
 # - de-duplicates messages using (origin, seq)
-# - per-peer logfile: peer_<name>.log
+# - per-peer logfile: peer_<name>.log (buffered, flushed every LOG_FLUSH_INTERVAL)
 # - clean Ctrl+C shutdown
 
 import socket
+import struct
+import selectors
 import threading
 import sys
 import json
+import os
 import time
 import signal
 from datetime import datetime
 
+try:
+    import orjson
+    dumps = orjson.dumps      # already returns bytes
+    loads = orjson.loads      # accepts bytes directly
+except ImportError:
+    def dumps(obj):
+        return json.dumps(obj, separators=(",", ":")).encode()
+    loads = json.loads
+
 COORD_HOST = "127.0.0.1"
 COORD_PORT = 9000
+UDP_SNDBUF = 4 * 1024 * 1024  # room for forwarding bursts so sendto doesn't stall the receive loop
+UDP_RCVBUF = 8 * 1024 * 1024  # absorbs bursts while io_loop is busy; on loopback, overflow is the only loss
+UDP_BATCH = 64                # most datagrams handle_udp_batch reads per wakeup
+LOG_FLUSH_INTERVAL = 0.1      # seconds between flushes of the buffered log file
+SEEN_WINDOW = 32768           # seqs per origin tracked for duplicate suppression (one bit each)
+VERBOSE = os.environ.get("PEER_VERBOSE", "1") != "0"  # PEER_VERBOSE=0 stops per-message console output
+
+# Data datagrams: DATA_HDR (type tag, seq, origin name length), then the origin name and
+# the message text, both UTF-8. Forwarders pass the datagram on unchanged. Datagrams
+# starting with "{" are read as the older JSON format.
+DATA_HDR = struct.Struct("!BIH")
+TAG_DATA = 1
+MAX_NAME_BYTES = 1024   # longest origin name (UTF-8) a peer may use; checked at startup
 running = True
 
+# one connection to the coordinator, reused for register / lookup / list
+coord_sock = None
+coord_lock = threading.Lock()
+
 def nowts():
     return datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
 
+# peer_<name>.log is opened once by open_log() and written through a large buffer;
+# log_flusher() pushes it to disk every LOG_FLUSH_INTERVAL.
+log_fh = None
+
+def open_log(name):
+    global log_fh
+    log_fh = open(f"peer_{name}.log", "a", buffering=1 << 16)
+
 def log(name, text):
-    fname = f"peer_{name}.log"
-    with open(fname, "a") as f:
-        f.write(f"[{nowts()}] {text}\n")
+    try:
+        log_fh.write(f"[{nowts()}] {text}\n")
+    except ValueError:
+        # closed during shutdown
+        pass
+
+def log_lines(name, lines):
+    """Append several log lines with a single timestamp and write."""
+    ts = nowts()
+    try:
+        log_fh.writelines(f"[{ts}] {text}\n" for text in lines)
+    except ValueError:
+        pass
 
-def udp_listener(udp_sock, name, next_udp_port_holder, seen):
-    udp_sock.settimeout(1.0)
+def log_flusher():
     while running:
+        time.sleep(LOG_FLUSH_INTERVAL)
         try:
-            data, addr = udp_sock.recvfrom(65536)
-            # try parse
+            log_fh.flush()
+        except (ValueError, OSError):
+            pass
+
+def mark_seen(seen, origin, seq):
+    """Record (origin, seq) in `seen`; returns False if it was already there.
+
+    `seen` maps each origin to [base, bitmap], one bit per seq in [base, base + SEEN_WINDOW).
+    Seqs from one origin only grow, so the window slides forward when a seq runs past it;
+    anything that has fallen behind the window counts as already seen, however far behind,
+    so a stale or replayed datagram can never reopen seqs that were already delivered."""
+    entry = seen.get(origin)
+    if entry is None:
+        entry = seen[origin] = [max(0, seq - SEEN_WINDOW // 2) & ~7, bytearray(SEEN_WINDOW // 8)]
+    base, bm = entry
+    off = seq - base
+    if off < 0:
+        return False
+    if off >= SEEN_WINDOW:
+        # slide so seq lands in the middle of the window, keeping the newer half of the bits
+        shift = (off - SEEN_WINDOW // 2) >> 3
+        if shift >= len(bm):
+            bm[:] = bytes(len(bm))
+        else:
+            bm[:len(bm) - shift] = bm[shift:]
+            bm[len(bm) - shift:] = bytes(shift)
+        base = entry[0] = base + (shift << 3)
+        off = seq - base
+    i, bit = off >> 3, 1 << (off & 7)
+    if bm[i] & bit:
+        return False
+    bm[i] |= bit
+    return True
+
+# receive buffer reused for every datagram; only the io_loop thread reads the data socket
+_udp_buf = bytearray(65536)
+_udp_view = memoryview(_udp_buf)
+
+def handle_udp_batch(udp_sock, name, next_udp_port_holder, seen):
+    """Handle up to UDP_BATCH queued datagrams from the (non-blocking) data socket.
+    Each one is received into _udp_buf, deduplicated and forwarded straight from that
+    buffer; console and log output for the whole batch is written once at the end."""
+    nxt = next_udp_port_holder.get("port")
+    nxt_name = next_udp_port_holder.get("name")
+    out, logs = [], []
+    for _ in range(UDP_BATCH):
+        try:
+            n, addr = udp_sock.recvfrom_into(_udp_buf)
+        except (BlockingIOError, InterruptedError):
+            break
+        except OSError:
+            # e.g. ICMP port unreachable from an earlier forward; skip it
+            continue
+        data = _udp_view[:n]
+        if data[:1] == b"{":
             try:
-                msg = json.loads(data.decode())
+                msg = loads(bytes(data))
             except:
                 # ignore malformed
                 continue
-            typ = msg.get("type")
-            if typ == "data":
-                origin = msg.get("origin")
-                seq = msg.get("seq")
-                key = (origin, seq)
-                if key in seen:
-                    # already processed -> ignore
-                    continue
-                seen.add(key)
-                sender = msg.get("sender", "-")
-                payload = msg.get("msg", "")
-                print(f"[{name} RECV] origin={origin} seq={seq} from {sender}: {payload}")
-                log(name, f"RECV origin={origin} seq={seq} from {sender}: {payload}")
-                # forward downstream to next peer (if any)
-                nxt = next_udp_port_holder.get("port")
-                if nxt:
-                    try:
-                        udp_sock.sendto(data, ("127.0.0.1", nxt))
-                        log(name, f"FORWARDED origin={origin} seq={seq} to {next_udp_port_holder.get('name')}:{nxt}")
-                    except Exception as e:
-                        print(f"[{name}] forward error: {e}")
-                        log(name, f"FORWARD_FAILED origin={origin} seq={seq} err={e}")
-            # ignore other types on UDP
-        except socket.timeout:
-            continue
-        except Exception:
+            if msg.get("type") != "data":
+                continue
+            origin, seq = msg.get("origin"), msg.get("seq")
+            # legacy datagrams are unvalidated input; anything odd is dropped, not allowed
+            # to raise and end io_loop
+            if not isinstance(origin, str) or not isinstance(seq, int) or seq < 0:
+                continue
+            sender, payload = msg.get("sender", "-"), msg.get("msg", "")
+        else:
+            parsed = unpack_data(data)
+            if parsed is None:
+                continue
+            origin, seq, payload = parsed
+            sender = origin   # forwarders never rewrite the datagram
+        if not mark_seen(seen, origin, seq):
+            # already processed -> ignore
             continue
-    udp_sock.close()
-    print(f"[{name}] UDP listener exiting.")
-
-def ctrl_server(ctrl_port, next_udp_port_holder, name):
-    serv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    serv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    serv.bind(("127.0.0.1", ctrl_port))
-    serv.listen(5)
-    serv.settimeout(1.0)
+        out.append(f"[{name} RECV] origin={origin} seq={seq} from {sender}: {payload}")
+        logs.append(f"RECV origin={origin} seq={seq} from {sender}: {payload}")
+        # forward downstream to next peer (if any)
+        if nxt:
+            try:
+                udp_sock.sendto(data, ("127.0.0.1", nxt))
+                logs.append(f"FORWARDED origin={origin} seq={seq} to {nxt_name}:{nxt}")
+            except Exception as e:
+                out.append(f"[{name}] forward error: {e}")
+                logs.append(f"FORWARD_FAILED origin={origin} seq={seq} err={e}")
+    if out and VERBOSE:
+        print("\n".join(out))
+    if logs:
+        log_lines(name, logs)
+
+_origin_bytes = {}   # origin name -> its encoded form; a peer only ever originates as itself
+
+def pack_data(origin, seq, text):
+    o = _origin_bytes.get(origin)
+    if o is None:
+        o = _origin_bytes[origin] = origin.encode()
+    return b"".join((DATA_HDR.pack(TAG_DATA, seq, len(o)), o, text.encode()))
+
+def unpack_data(data):
+    """Return (origin, seq, text) for a binary data datagram, or None if it isn't one."""
+    if len(data) < DATA_HDR.size:
+        return None
+    tag, seq, olen = DATA_HDR.unpack_from(data)
+    end = DATA_HDR.size + olen
+    if tag != TAG_DATA or len(data) < end:
+        return None
+    try:
+        # str() decodes straight from a bytes or memoryview slice
+        return str(data[DATA_HDR.size:end], "utf-8"), seq, str(data[end:], "utf-8", "replace")
+    except UnicodeDecodeError:
+        return None
+
+def send_data(udp_sock, port, origin, seq, text):
+    """Send a data message originating at this peer to the given UDP port."""
+    udp_sock.sendto(pack_data(origin, seq, text), ("127.0.0.1", port))
+
+def handle_ctrl_msg(raw, next_udp_port_holder, name):
+    """Apply one JSON control command received on the control port.
+    Returns the UPDATE_NEXT message if that is what it was, otherwise None."""
+    try:
+        msg = loads(raw)
+    except:
+        return None
+    if not isinstance(msg, dict) or msg.get("cmd") != "UPDATE_NEXT":
+        return None
+    next_name = msg.get("next_name")
+    next_port = msg.get("next_port")
+    # the coordinator may resend an UPDATE_NEXT whose ack was lost; only report changes
+    if next_udp_port_holder["port"] != next_port or next_udp_port_holder["name"] != next_name:
+        print(f"[{name} CTRL] UPDATE_NEXT -> {next_name}:{next_port}")
+        log(name, f"CTRL UPDATE_NEXT -> {next_name}:{next_port}")
+        next_udp_port_holder["port"] = next_port
+        next_udp_port_holder["name"] = next_name
+    return msg
+
+def io_loop(udp_sock, ctrl_udp, wake_r, name, next_udp_port_holder, seen):
+    """Serve the data and control sockets from one selector.
+
+    Nothing here polls: select() sleeps until a socket is readable, and shutdown writes
+    a byte to wake_r (directly, or via signal.set_wakeup_fd on Ctrl+C)."""
+    sel = selectors.DefaultSelector()
+    sel.register(udp_sock, selectors.EVENT_READ, "udp")
+    sel.register(ctrl_udp, selectors.EVENT_READ, "ctrl_udp")
+    sel.register(wake_r, selectors.EVENT_READ, "wake")
     while running:
-        try:
-            conn, addr = serv.accept()
-            with conn:
-                raw = conn.recv(4096).decode()
-                if not raw:
-                    continue
+        for key, _ in sel.select():
+            kind = key.data
+            if kind == "udp":
+                handle_udp_batch(udp_sock, name, next_udp_port_holder, seen)
+            elif kind == "ctrl_udp":
                 try:
-                    msg = json.loads(raw)
-                except:
+                    raw, addr = ctrl_udp.recvfrom(2048)
+                except OSError:
                     continue
-                if msg.get("cmd") == "UPDATE_NEXT":
-                    next_name = msg.get("next_name")
-                    next_port = msg.get("next_port")
-                    print(f"[{name} CTRL] UPDATE_NEXT -> {next_name}:{next_port}")
-                    log(name, f"CTRL UPDATE_NEXT -> {next_name}:{next_port}")
-                    next_udp_port_holder["port"] = next_port
-                    next_udp_port_holder["name"] = next_name
+                msg = handle_ctrl_msg(raw, next_udp_port_holder, name)
+                if msg is not None:
+                    # the coordinator resends UPDATE_NEXT until it sees this
                     try:
-                        conn.sendall(b"OK")
-                    except:
+                        ctrl_udp.sendto(dumps({"cmd": "ACK_NEXT", "next_port": msg.get("next_port")}), addr)
+                    except OSError:
                         pass
-        except socket.timeout:
-            continue
-        except Exception:
-            continue
-    serv.close()
-    print(f"[{name}] control server exiting.")
+            else:
+                # shutdown wakeup; the loop condition does the rest
+                try:
+                    wake_r.recv(512)
+                except BlockingIOError:
+                    pass
+    sel.close()
+    print(f"[{name}] I/O loop exiting.")
 
 def sigint_handler(sig, frame):
     global running
     print("\n[Peer] Caught interrupt, shutting down...")
     running = False
 
+def _nodelay(s):
+    """Disable Nagle (and, on Linux, delayed ACKs) so small control messages go out at once."""
+    s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if hasattr(socket, "TCP_QUICKACK"):
+        try:
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+        except OSError:
+            pass
+
+# Coordinator requests and replies are framed as a 4-byte big-endian length + JSON body.
+def recv_exact(sock, n):
+    """Read exactly n bytes from sock. Returns None if the connection closes first."""
+    buf = bytearray(n)
+    mv = memoryview(buf)
+    got = 0
+    while got < n:
+        k = sock.recv_into(mv[got:])
+        if not k:
+            return None
+        got += k
+    return buf
+
+def recv_frame(sock):
+    hdr = recv_exact(sock, 4)
+    if hdr is None:
+        return None
+    return recv_exact(sock, int.from_bytes(hdr, "big"))
+
+def send_frame(sock, body):
+    hdr = len(body).to_bytes(4, "big")
+    if not hasattr(sock, "sendmsg"):
+        # Windows has no sendmsg
+        sock.sendall(hdr + body)
+        return
+    # gather-write header and body in one syscall without concatenating them
+    sent = sock.sendmsg([hdr, body])
+    if sent < len(hdr):
+        sock.sendall(hdr[sent:])
+        sock.sendall(body)
+    elif sent < len(hdr) + len(body):
+        sock.sendall(memoryview(body)[sent - len(hdr):])
+
+def coord_request(req, retry=True):
+    """Send one request over the shared coordinator connection and return the decoded reply."""
+    global coord_sock
+    with coord_lock:
+        attempts = 2 if retry else 1
+        for attempt in range(attempts):
+            try:
+                if coord_sock is None:
+                    coord_sock = socket.create_connection((COORD_HOST, COORD_PORT), timeout=5)
+                    _nodelay(coord_sock)
+                send_frame(coord_sock, dumps(req))
+                raw = recv_frame(coord_sock)
+                if raw is None:
+                    # coordinator closed the idle connection; reconnect and resend
+                    raise ConnectionError("coordinator closed the connection")
+                return loads(raw)
+            except Exception:
+                try:
+                    coord_sock.close()
+                except:
+                    pass
+                coord_sock = None
+                if attempt == attempts - 1:
+                    raise
+
 def query_coordinator_lookup(target_name):
     """Query coordinator for peer info by name. Returns dict or {}."""
     try:
-        with socket.create_connection((COORD_HOST, COORD_PORT), timeout=3) as s:
-            s.sendall(json.dumps({"type":"lookup", "name": target_name}).encode())
-            raw = s.recv(4096).decode()
-            return json.loads(raw) if raw else {}
+        return coord_request({"type":"lookup", "name": target_name})
     except Exception as e:
         print("[peer] coordinator lookup error:", e)
         return {}
@@ -129,16 +342,38 @@ if __name__ == "__main__":
         sys.exit(1)
 
     name = sys.argv[1]
+    if len(name.encode()) > MAX_NAME_BYTES:
+        print(f"Peer name is {len(name.encode())} bytes in UTF-8; the limit is {MAX_NAME_BYTES}.")
+        sys.exit(1)
     udp_port = int(sys.argv[2])
     ctrl_port = udp_port + 10000
 
+    open_log(name)
+
+    # shared holder for next peer
+    next_udp_port_holder = {"port": None, "name": None}
+
+    # UDP socket for data
+    udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    # the kernel may clamp these to net.core.wmem_max / rmem_max
+    udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, UDP_SNDBUF)
+    udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_RCVBUF)
+    udp_sock.bind(("127.0.0.1", udp_port))
+    udp_sock.setblocking(False)
+
+    # control port: UPDATE_NEXT datagrams from the coordinator. Both sockets are bound before
+    # registering, so an UPDATE_NEXT sent right after our registration has somewhere to land.
+    ctrl_udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    ctrl_udp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    ctrl_udp.bind(("127.0.0.1", ctrl_port))
+    ctrl_udp.setblocking(False)
+
     # Register with coordinator
     reg = {"type":"register", "name": name, "port": udp_port, "ctrl_port": ctrl_port}
     try:
-        with socket.create_connection((COORD_HOST, COORD_PORT), timeout=5) as s:
-            s.sendall(json.dumps(reg).encode())
-            resp = s.recv(8192).decode()
-            prev_info = json.loads(resp) if resp else {}
+        # not retried: a resent register would add this peer to the chain twice
+        prev_info = coord_request(reg, retry=False)
     except Exception as e:
         print(f"[{name}] Failed to register with coordinator: {e}")
         sys.exit(1)
@@ -150,22 +385,20 @@ if __name__ == "__main__":
     print(f"[{name}] Registered. previous peer: {prev_name or 'NONE'} (port={prev_port or 'N/A'})")
     log(name, f"Registered with coordinator. prev={prev_name}:{prev_port}")
 
-    # shared holder for next peer
-    next_udp_port_holder = {"port": None, "name": None}
+    # self-pipe that wakes io_loop for shutdown; Ctrl+C writes to it through set_wakeup_fd
+    wake_r, wake_w = socket.socketpair()
+    wake_r.setblocking(False)
+    wake_w.setblocking(False)
+    signal.set_wakeup_fd(wake_w.fileno())
 
-    # UDP socket for data
-    udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    udp_sock.bind(("127.0.0.1", udp_port))
-
-    # seen messages (to avoid duplicates)
-    seen = set()
+    # recently seen messages (to avoid duplicates): origin -> sliding seq bitmap, see mark_seen
+    seen = {}
 
     # start threads
-    t_udp = threading.Thread(target=udp_listener, args=(udp_sock, name, next_udp_port_holder, seen), daemon=True)
-    t_udp.start()
-    t_ctrl = threading.Thread(target=ctrl_server, args=(ctrl_port, next_udp_port_holder, name), daemon=True)
-    t_ctrl.start()
+    t_io = threading.Thread(target=io_loop, args=(udp_sock, ctrl_udp, wake_r, name, next_udp_port_holder, seen), daemon=True)
+    t_io.start()
+    t_log = threading.Thread(target=log_flusher, daemon=True)
+    t_log.start()
 
     # interactive loop for any peer: supports:
     # - plain text: send a data message originating from this peer downstream
@@ -198,11 +431,8 @@ if __name__ == "__main__":
         if line.strip().lower() == "list":
             # ask coordinator for peers
             try:
-                with socket.create_connection((COORD_HOST, COORD_PORT), timeout=3) as s:
-                    s.sendall(json.dumps({"type":"list"}).encode())
-                    raw = s.recv(8192).decode()
-                    lst = json.loads(raw) if raw else []
-                    print("Peers:", lst)
+                lst = coord_request({"type":"list"})
+                print("Peers:", lst)
             except Exception as e:
                 print("Coordinator list error:", e)
             continue
@@ -221,9 +451,8 @@ if __name__ == "__main__":
                 continue
             # build a data message (origin is this peer)
             seq += 1
-            payload = {"type":"data","origin":name,"seq":seq,"sender":name,"msg":msg_text}
             try:
-                udp_sock.sendto(json.dumps(payload).encode(), ("127.0.0.1", target_port))
+                send_data(udp_sock, target_port, name, seq, msg_text)
                 print(f"[{name}] Sent direct to {target} ({target_port}) seq={seq}")
                 log(name, f"SENT_DIRECT to {target}:{target_port} origin={name} seq={seq} msg={msg_text}")
             except Exception as e:
@@ -232,15 +461,14 @@ if __name__ == "__main__":
 
         # default: originate a message that will propagate downstream
         seq += 1
-        payload = {"type":"data","origin":name,"seq":seq,"sender":name,"msg":line}
         nxt = next_udp_port_holder.get("port")
         if nxt:
             try:
-                udp_sock.sendto(json.dumps(payload).encode(), ("127.0.0.1", nxt))
+                send_data(udp_sock, nxt, name, seq, line)
                 print(f"[{name}] Originated seq={seq} -> forwarded to {next_udp_port_holder.get('name')}:{nxt}")
                 log(name, f"SENT origin={name} seq={seq} to {next_udp_port_holder.get('name')}:{nxt} msg={line}")
                 # mark as seen so origin doesn't get processed again on receipt
-                seen.add((name, seq))
+                mark_seen(seen, name, seq)
             except Exception as e:
                 print(f"[{name}] send error: {e}")
                 log(name, f"SEND_ERROR origin={name} seq={seq} err={e}")
@@ -252,10 +480,19 @@ if __name__ == "__main__":
     # shutdown
     running = False
     print(f"[{name}] Shutting down, waiting for threads...")
-    t_udp.join(timeout=1.0)
-    t_ctrl.join(timeout=1.0)
     try:
-        udp_sock.close()
-    except:
+        wake_w.send(b"\0")
+    except OSError:
         pass
+    t_io.join(timeout=1.0)
+    t_log.join(timeout=1.0)
+    log_fh.close()
+    signal.set_wakeup_fd(-1)
+    for sock in (udp_sock, ctrl_udp, wake_r, wake_w):
+        try:
+            sock.close()
+        except:
+            pass
+    if coord_sock is not None:
+        coord_sock.close()
     print(f"[{name}] Exit.")